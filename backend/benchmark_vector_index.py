@@ -0,0 +1,92 @@
+"""Recall/latency benchmark for the message vector index on synthetic histories.
+
+Each synthetic conversation is filler chatter with a few planted "needle"
+messages on distinct topics. Queries reuse part of a needle's wording mixed
+with filler words, and recall@k is the fraction of queries whose needle is
+retrieved in the top k.
+
+Usage: python benchmark_vector_index.py [--sizes 1000 10000 50000] [--k 5]
+"""
+import argparse
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+import numpy as np
+
+from vector_index import VectorIndexStore, load_embedder
+
+def make_words(rng, count: int, prefix: str) -> list:
+    return [f"{prefix}{i}" for i in rng.permutation(count)]
+
+def make_message(rng, vocabulary: list, low: int = 8, high: int = 30) -> str:
+    return " ".join(rng.choice(vocabulary, size=rng.integers(low, high)))
+
+def percentile(values: list, p: float) -> float:
+    return float(np.percentile(np.array(values) * 1000, p))
+
+def run(history_size: int, needles: int, k: int, embedder_spec: str, seed: int):
+    rng = np.random.default_rng(seed)
+    filler = make_words(rng, 2000, "w")
+    topics = [make_words(rng, 12, f"t{topic}_") for topic in range(needles)]
+
+    needle_rows = set(rng.choice(history_size, size=needles, replace=False).tolist())
+    needle_topics = dict(zip(sorted(needle_rows), range(needles)))
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = VectorIndexStore(Path(directory), load_embedder(embedder_spec))
+        user_id = str(uuid.uuid4())
+        conversation_id = str(uuid.uuid4())
+        needle_ids = {}
+
+        insert_times = []
+        for row in range(history_size):
+            message_id = str(uuid.uuid4())
+            if row in needle_topics:
+                topic = needle_topics[row]
+                text = " ".join(topics[topic]) + " " + make_message(rng, filler, 4, 10)
+                needle_ids[topic] = message_id
+            else:
+                text = make_message(rng, filler)
+            started = time.perf_counter()
+            store.add_message(user_id, message_id, conversation_id, text)
+            insert_times.append(time.perf_counter() - started)
+
+        # Reopen from disk so searches run against the memory-mapped files
+        store = VectorIndexStore(Path(directory), store.embedder)
+
+        hits = 0
+        search_times = []
+        for topic in range(needles):
+            query_terms = list(rng.choice(topics[topic], size=4, replace=False))
+            query = " ".join(query_terms) + " " + make_message(rng, filler, 4, 8)
+            started = time.perf_counter()
+            results = store.search(user_id, conversation_id, query, k)
+            search_times.append(time.perf_counter() - started)
+            if needle_ids[topic] in {message_id for message_id, _ in results}:
+                hits += 1
+
+        index_bytes = sum(path.stat().st_size for path in Path(directory).iterdir())
+
+    print(
+        f"{history_size:>8} msgs | recall@{k} {hits / needles:6.1%} | "
+        f"insert p50 {percentile(insert_times, 50):6.3f} ms p95 {percentile(insert_times, 95):6.3f} ms | "
+        f"search p50 {percentile(search_times, 50):7.3f} ms p95 {percentile(search_times, 95):7.3f} ms | "
+        f"index {index_bytes / 1024:8.1f} KiB"
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--needles", type=int, default=50)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--embedder", default="", help='"module:factory", defaults to the hashing embedder')
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        run(size, min(args.needles, size), args.k, args.embedder, args.seed)
+
+if __name__ == "__main__":
+    main()
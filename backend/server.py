@@ -1,13 +1,25 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Header, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.websockets import WebSocketState
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import BulkWriteError
 import os
+import sys
+import asyncio
+import hmac
+import random
+import threading
+import time
+import zlib
 import logging
+from collections import Counter, deque
+from contextvars import ContextVar
+from cachetools import TTLCache
 from pathlib import Path
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
 from typing import List, Optional, AsyncGenerator
 import uuid
 from datetime import datetime, timezone, timedelta
@@ -16,6 +28,7 @@ from emergentintegrations.llm.chat import LlmChat, UserMessage
 import jwt
 import bcrypt
 from email_validator import validate_email, EmailNotValidError
+from vector_index import VectorIndexStore, load_embedder
 
 
 ROOT_DIR = Path(__file__).parent
@@ -43,6 +56,44 @@ JWT_EXPIRATION_HOURS = 24
 # Security
 security = HTTPBearer()
 
+# Admin token for operational endpoints (disabled when empty)
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+
+# Request profiling configuration (off unless PROFILING_ENABLED is set)
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', 'false').lower() == 'true'
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', '5'))
+PROFILE_MAX_STORED = int(os.environ.get('PROFILE_MAX_STORED', '50'))
+PROFILE_MAX_TIMELINE = 5000
+
+# Conversation tiering configuration
+ARCHIVE_ENABLED = os.environ.get('ARCHIVE_ENABLED', 'true').lower() == 'true'
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', '90'))
+ARCHIVE_INTERVAL_MINUTES = int(os.environ.get('ARCHIVE_INTERVAL_MINUTES', '60'))
+ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE', '100'))
+ACCESS_TOUCH_INTERVAL = timedelta(hours=int(os.environ.get('ACCESS_TOUCH_INTERVAL_HOURS', '24')))
+
+# WebSocket chat configuration
+WS_HEARTBEAT_SECONDS = int(os.environ.get('WS_HEARTBEAT_SECONDS', '25'))
+WS_SEND_QUEUE_SIZE = int(os.environ.get('WS_SEND_QUEUE_SIZE', '64'))
+WS_MAX_GENERATIONS = int(os.environ.get('WS_MAX_GENERATIONS', '4'))
+
+# Conditional GET configuration. Versions are cached per process and
+# invalidated on local writes; the TTL bounds staleness across workers.
+ETAG_CACHE_TTL_SECONDS = int(os.environ.get('ETAG_CACHE_TTL_SECONDS', '30'))
+ETAG_CACHE_MAX_ENTRIES = int(os.environ.get('ETAG_CACHE_MAX_ENTRIES', '10000'))
+
+# History retrieval configuration
+VECTOR_INDEX_ENABLED = os.environ.get('VECTOR_INDEX_ENABLED', 'true').lower() == 'true'
+VECTOR_INDEX_DIR = Path(os.environ.get('VECTOR_INDEX_DIR', str(ROOT_DIR / 'data' / 'message_vectors')))
+EMBEDDER = os.environ.get('EMBEDDER', '')  # "module:factory", defaults to the hashing embedder
+RETRIEVAL_TOP_K = int(os.environ.get('RETRIEVAL_TOP_K', '5'))
+RETRIEVAL_TOKEN_BUDGET = int(os.environ.get('RETRIEVAL_TOKEN_BUDGET', '1000'))
+RECENT_HISTORY_LIMIT = 10
+RECENT_HISTORY_TOKEN_BUDGET = int(os.environ.get('RECENT_HISTORY_TOKEN_BUDGET', '2000'))
+
+vector_store = VectorIndexStore(VECTOR_INDEX_DIR, load_embedder(EMBEDDER)) if VECTOR_INDEX_ENABLED else None
+
 # Define Models
 class StatusCheck(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -134,20 +185,469 @@ def create_access_token(user_id: str) -> str:
     to_encode = {"user_id": user_id, "exp": expire}
     return jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+def decode_access_token(token: str) -> dict:
     try:
-        payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        user_id = payload.get("user_id")
-        if user_id is None:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        
-        user = await db.users.find_one({"id": user_id})
-        if user is None:
-            raise HTTPException(status_code=401, detail="User not found")
-        
-        return User(**parse_from_mongo(user))
+        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
     except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
+    if payload.get("user_id") is None:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return payload
+
+async def get_user_from_payload(payload: dict) -> User:
+    user = await db.users.find_one({"id": payload["user_id"]})
+    if user is None:
+        raise HTTPException(status_code=401, detail="User not found")
+    
+    return User(**parse_from_mongo(user))
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    return await get_user_from_payload(decode_access_token(credentials.credentials))
+
+# Request profiling helpers
+# Id of the profile the current request belongs to; inherited by any task
+# the request spawns, such as the one streaming a StreamingResponse body.
+profiled_request: ContextVar[Optional[str]] = ContextVar("profiled_request", default=None)
+
+class RequestProfiler:
+    """Samples the event loop thread's stack from a background thread.
+
+    Only samples taken while one of the profiled request's tasks holds the
+    loop go into the collapsed stacks (one ``frame;frame count`` line each,
+    as consumed by flamegraph.pl or speedscope), rooted at the request and
+    task name. Samples from other requests are only counted, and the
+    timeline shows which of the request's tasks held the loop and when.
+    """
+
+    def __init__(self, profile_id: str, label: str, interval: float):
+        self.profile_id = profile_id
+        self.label = label
+        self.interval = interval
+        self.loop = asyncio.get_running_loop()
+        self.thread_id = threading.get_ident()
+        self.request_tasks = set()
+        self.stacks = Counter()
+        self.timeline = []
+        self.sample_count = 0
+        self.other_sample_count = 0
+        self.idle_sample_count = 0
+        self.started = 0.0
+        self.duration = 0.0
+        self._previous_task_factory = None
+        self._context_token = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+
+    def _task_factory(self, loop, coro, **kwargs):
+        if self._previous_task_factory is not None:
+            task = self._previous_task_factory(loop, coro, **kwargs)
+        else:
+            task = asyncio.Task(coro, loop=loop, **kwargs)
+        context = kwargs.get("context")
+        owner = context.get(profiled_request) if context is not None else profiled_request.get()
+        if owner == self.profile_id:
+            self.request_tasks.add(task)
+        return task
+
+    def start(self):
+        # Tag the calling task and, through the task factory, every task it spawns
+        self._context_token = profiled_request.set(self.profile_id)
+        self.request_tasks.add(asyncio.current_task())
+        self._previous_task_factory = self.loop.get_task_factory()
+        self.loop.set_task_factory(self._task_factory)
+        self.started = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.loop.set_task_factory(self._previous_task_factory)
+        profiled_request.reset(self._context_token)
+        self.request_tasks.clear()
+        self.duration = time.perf_counter() - self.started
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            task = asyncio.current_task(self.loop)
+            if task is None:
+                task_name = "<event loop>"
+                self.idle_sample_count += 1
+            elif task in self.request_tasks:
+                task_name = task.get_name()
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append(f"{code.co_name} ({Path(code.co_filename).name})")
+                    frame = frame.f_back
+                frames.append(task_name)
+                frames.append(self.label)
+                frames.reverse()
+                self.stacks[";".join(frames)] += 1
+                self.sample_count += 1
+            else:
+                task_name = "<other requests>"
+                self.other_sample_count += 1
+
+            elapsed_ms = round((time.perf_counter() - self.started) * 1000, 2)
+            if self.timeline and self.timeline[-1]["task"] == task_name:
+                self.timeline[-1]["end_ms"] = elapsed_ms
+            elif len(self.timeline) < PROFILE_MAX_TIMELINE:
+                self.timeline.append({"task": task_name, "start_ms": elapsed_ms, "end_ms": elapsed_ms})
+
+    def collapsed(self) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+def is_admin_token(token: Optional[str]) -> bool:
+    if not ADMIN_TOKEN or not token:
+        return False
+    return hmac.compare_digest(token.encode('utf-8'), ADMIN_TOKEN.encode('utf-8'))
+
+async def store_request_profile(profile: dict):
+    await db.request_profiles.insert_one(prepare_for_mongo(profile))
+
+    # Enforce the retention cap by dropping the oldest profiles
+    stale = await db.request_profiles.find({}, {"id": 1}).sort("started_at", -1).skip(PROFILE_MAX_STORED).to_list(None)
+    if stale:
+        await db.request_profiles.delete_many({"id": {"$in": [doc["id"] for doc in stale]}})
+
+class RequestProfilerMiddleware:
+    """Profiles API requests that carry a valid X-Admin-Token header or
+    are picked by PROFILE_SAMPLE_RATE. Only one request is profiled at a
+    time; the middleware is only installed when PROFILING_ENABLED is set."""
+
+    def __init__(self, app):
+        self.app = app
+        self.busy = False
+
+    def should_profile(self, scope) -> bool:
+        path = scope["path"]
+        if not path.startswith("/api/") or path.startswith("/api/admin/profiles"):
+            return False
+        for name, value in scope["headers"]:
+            if name == b"x-admin-token":
+                return is_admin_token(value.decode('latin-1'))
+        return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self.busy or not self.should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        self.busy = True
+        profile_id = str(uuid.uuid4())
+        started_at = datetime.now(timezone.utc)
+        status_code = None
+        profiler = RequestProfiler(profile_id, f"{scope['method']} {scope['path']}", PROFILE_INTERVAL_MS / 1000)
+
+        async def send_with_profile_id(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                message.setdefault("headers", []).append((b"x-profile-id", profile_id.encode('latin-1')))
+            await send(message)
+
+        profiler.start()
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            profiler.stop()
+            self.busy = False
+            try:
+                await store_request_profile({
+                    "id": profile_id,
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "status_code": status_code,
+                    "started_at": started_at,
+                    "duration_ms": round(profiler.duration * 1000, 2),
+                    "interval_ms": PROFILE_INTERVAL_MS,
+                    "sample_count": profiler.sample_count,
+                    "other_sample_count": profiler.other_sample_count,
+                    "idle_sample_count": profiler.idle_sample_count,
+                    "collapsed": profiler.collapsed(),
+                    "timeline": profiler.timeline,
+                })
+            except Exception as e:
+                logger.error(f"Error storing request profile: {str(e)}")
+
+async def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not is_admin_token(x_admin_token):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+async def require_profile_admin(_: None = Depends(require_admin)):
+    if not PROFILING_ENABLED:
+        raise HTTPException(status_code=404, detail="Profiling is disabled")
+
+# Conversation tiering helpers
+tiering_metrics = {
+    "archived_total": 0,
+    "rehydrated_total": 0,
+    "rehydration_ms": deque(maxlen=1000),
+    "last_run_at": None,
+    "last_run_archived": 0,
+}
+
+def pack_messages(messages: List[dict]) -> bytes:
+    return zlib.compress(json.dumps(messages).encode('utf-8'))
+
+def unpack_messages(block: bytes) -> List[dict]:
+    return json.loads(zlib.decompress(block))
+
+async def touch_conversation(conversation: dict):
+    """Record a read of a hot conversation so the tiering job sees it as active.
+
+    Writes at most once per ACCESS_TOUCH_INTERVAL per conversation.
+    """
+    now = datetime.now(timezone.utc)
+    if conversation.get("accessed_at", "") >= (now - ACCESS_TOUCH_INTERVAL).isoformat():
+        return
+    conversation["accessed_at"] = now.isoformat()
+    await db.conversations.update_one({"id": conversation["id"]}, {"$set": {"accessed_at": conversation["accessed_at"]}})
+
+async def restore_messages(messages: List[dict]):
+    """Insert archived messages back into the hot collection.
+
+    The unique index on messages.id makes this idempotent: messages that are
+    already hot (from an earlier or concurrent restore) are skipped.
+    """
+    try:
+        await db.messages.insert_many(messages, ordered=False)
+    except BulkWriteError as e:
+        if any(error["code"] != 11000 for error in e.details.get("writeErrors", [])):
+            raise
+
+async def archive_conversation(conversation: dict) -> bool:
+    """Move a conversation's messages into a single compressed archive block.
+
+    The block is written and the hot messages deleted before the conversation
+    is flagged, and the flag is only set if the conversation hasn't been
+    written to or read since it was picked. Otherwise the move is undone and
+    False is returned.
+    """
+    conversation_id = conversation["id"]
+    messages = await db.messages.find(
+        {"conversation_id": conversation_id}, {"_id": 0}
+    ).sort("timestamp", 1).to_list(None)
+
+    if messages:
+        # Merge with any block left behind by an interrupted earlier run
+        existing = await db.archived_conversations.find_one({"conversation_id": conversation_id})
+        archived_ids = {msg["id"] for msg in messages}
+        if existing:
+            older = [msg for msg in await asyncio.to_thread(unpack_messages, existing["messages"]) if msg["id"] not in archived_ids]
+            messages = sorted(older + messages, key=lambda msg: msg["timestamp"])
+
+        await db.archived_conversations.replace_one(
+            {"conversation_id": conversation_id},
+            {
+                "conversation_id": conversation_id,
+                "user_id": conversation.get("user_id"),
+                "message_count": len(messages),
+                "archived_at": datetime.now(timezone.utc).isoformat(),
+                "messages": await asyncio.to_thread(pack_messages, messages),
+            },
+            upsert=True
+        )
+
+        # Only delete what was archived so a message written meanwhile stays hot
+        await db.messages.delete_many({"conversation_id": conversation_id, "id": {"$in": list(archived_ids)}})
+
+    result = await db.conversations.update_one(
+        {
+            "id": conversation_id,
+            "archived": {"$ne": True},
+            "updated_at": conversation.get("updated_at"),
+            "accessed_at": conversation.get("accessed_at"),
+        },
+        {"$set": {"archived": True}}
+    )
+    if result.matched_count:
+        return True
+
+    current = await db.conversations.find_one({"id": conversation_id}, {"_id": 0, "archived": 1})
+    if current and current.get("archived"):
+        # Another worker archived it first; its block now includes ours
+        return False
+    if current and messages:
+        await restore_messages(messages)
+    await db.archived_conversations.delete_one({"conversation_id": conversation_id})
+    return False
+
+async def rehydrate_conversation(conversation: dict):
+    """Promote an archived conversation back to the hot messages collection.
+
+    The conversation document is updated in place so callers holding on to
+    it (such as a WebSocket session) don't rehydrate it again.
+    """
+    if not conversation.get("archived"):
+        return
+
+    started = time.perf_counter()
+    conversation_id = conversation["id"]
+    archive = await db.archived_conversations.find_one({"conversation_id": conversation_id})
+    if archive:
+        messages = await asyncio.to_thread(unpack_messages, archive["messages"])
+        if messages:
+            await restore_messages(messages)
+
+    accessed_at = datetime.now(timezone.utc).isoformat()
+    result = await db.conversations.update_one(
+        {"id": conversation_id, "archived": True},
+        {
+            "$set": {"accessed_at": accessed_at},
+            "$unset": {"archived": ""},
+        }
+    )
+    conversation.pop("archived", None)
+    conversation["accessed_at"] = accessed_at
+
+    # A concurrent rehydration that cleared the flag first owns the block
+    if result.matched_count:
+        await db.archived_conversations.delete_one({"conversation_id": conversation_id})
+        tiering_metrics["rehydrated_total"] += 1
+        tiering_metrics["rehydration_ms"].append((time.perf_counter() - started) * 1000)
+
+async def archive_idle_conversations() -> int:
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=ARCHIVE_AFTER_DAYS)).isoformat()
+    idle_conversations = await db.conversations.find(
+        {
+            "archived": {"$ne": True},
+            "updated_at": {"$lt": cutoff},
+            "$or": [{"accessed_at": {"$exists": False}}, {"accessed_at": {"$lt": cutoff}}],
+        },
+        {"_id": 0, "id": 1, "user_id": 1, "updated_at": 1, "accessed_at": 1}
+    ).to_list(ARCHIVE_BATCH_SIZE)
+
+    archived = 0
+    for conversation in idle_conversations:
+        try:
+            if await archive_conversation(conversation):
+                archived += 1
+        except Exception as e:
+            logger.error(f"Error archiving conversation {conversation['id']}: {str(e)}")
+
+    tiering_metrics["archived_total"] += archived
+    tiering_metrics["last_run_at"] = datetime.now(timezone.utc)
+    tiering_metrics["last_run_archived"] = archived
+    return archived
+
+async def run_tiering_job():
+    while True:
+        try:
+            # Keep draining full batches before sleeping
+            while await archive_idle_conversations() == ARCHIVE_BATCH_SIZE:
+                pass
+        except Exception as e:
+            logger.error(f"Error in tiering job: {str(e)}")
+        await asyncio.sleep(ARCHIVE_INTERVAL_MINUTES * 60)
+
+# Conditional GET helpers
+listing_etags = TTLCache(maxsize=ETAG_CACHE_MAX_ENTRIES, ttl=ETAG_CACHE_TTL_SECONDS)
+listing_etag_invalidations = 0
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in candidates or etag.removeprefix("W/") in candidates
+
+def invalidate_listing_etag(key: tuple):
+    global listing_etag_invalidations
+    listing_etag_invalidations += 1
+    listing_etags.pop(key, None)
+
+async def get_listing_etag(key: tuple, probe) -> str:
+    etag = listing_etags.get(key)
+    if etag is None:
+        invalidations = listing_etag_invalidations
+        etag = await probe()
+        # Don't cache a version a concurrent write may already have superseded
+        if invalidations == listing_etag_invalidations:
+            listing_etags[key] = etag
+    return etag
+
+async def probe_conversation_list_etag(user_id: str) -> str:
+    latest = await db.conversations.find_one(
+        {"user_id": user_id}, {"_id": 0, "updated_at": 1}, sort=[("updated_at", -1)]
+    )
+    count = await db.conversations.count_documents({"user_id": user_id})
+    return f'W/"{user_id}-{latest["updated_at"] if latest else ""}-{count}"'
+
+async def probe_message_list_etag(conversation_id: str) -> str:
+    latest = await db.messages.find_one(
+        {"conversation_id": conversation_id}, {"_id": 0, "timestamp": 1}, sort=[("timestamp", -1)]
+    )
+    return f'W/"{conversation_id}-{latest["timestamp"] if latest else ""}"'
+
+# History retrieval helpers
+def estimate_tokens(text: str) -> int:
+    # Rough 4-characters-per-token estimate, good enough for budgeting
+    return len(text) // 4 + 1
+
+async def index_message(user_id: str, message: ChatMessage):
+    if vector_store is None:
+        return
+    try:
+        await asyncio.to_thread(vector_store.add_message, user_id, message.id, message.conversation_id, message.content)
+    except Exception as e:
+        logger.error(f"Error indexing message {message.id}: {str(e)}")
+
+async def unindex_conversation(user_id: str, conversation_id: str):
+    if vector_store is None:
+        return
+    try:
+        await asyncio.to_thread(vector_store.drop_conversation, user_id, conversation_id)
+    except Exception as e:
+        logger.error(f"Error dropping conversation {conversation_id} from message index: {str(e)}")
+
+async def retrieve_relevant_history(user_id: str, conversation_id: str, content: str, exclude_ids) -> List[dict]:
+    """Return the most relevant older messages that fit the token budget, oldest first."""
+    if vector_store is None or RETRIEVAL_TOP_K <= 0:
+        return []
+    try:
+        hits = await asyncio.to_thread(
+            vector_store.search, user_id, conversation_id, content, RETRIEVAL_TOP_K, exclude_ids
+        )
+    except Exception as e:
+        logger.error(f"Error searching message index: {str(e)}")
+        return []
+    if not hits:
+        return []
+
+    found = await db.messages.find(
+        {"conversation_id": conversation_id, "id": {"$in": [message_id for message_id, _ in hits]}}, {"_id": 0}
+    ).to_list(len(hits))
+    by_id = {msg["id"]: msg for msg in found}
+
+    selected = []
+    budget = RETRIEVAL_TOKEN_BUDGET
+    for message_id, _ in hits:
+        msg = by_id.get(message_id)
+        if msg is None:
+            continue
+        cost = estimate_tokens(msg["content"])
+        if cost > budget:
+            continue
+        budget -= cost
+        selected.append(msg)
+    return sorted(selected, key=lambda msg: msg["timestamp"])
+
+def trim_recent_history(messages: List[dict]) -> List[dict]:
+    """Keep the newest messages (given newest first) that fit the recent history budget."""
+    kept = []
+    budget = RECENT_HISTORY_TOKEN_BUDGET
+    for msg in messages:
+        budget -= estimate_tokens(msg["content"])
+        if budget < 0:
+            break
+        kept.append(msg)
+    return kept
+
+def format_history(messages: List[dict]) -> str:
+    return "\n".join(f"{msg['role']}: {msg['content']}" for msg in messages)
 
 # Authentication endpoints
 @api_router.post("/auth/register", response_model=AuthResponse)
@@ -250,21 +750,42 @@ async def create_conversation(input: ConversationCreate, current_user: User = De
     prepared_data = prepare_for_mongo(conversation.dict())
     prepared_data["user_id"] = current_user.id  # Associate with user
     await db.conversations.insert_one(prepared_data)
+    invalidate_listing_etag(("conversations", current_user.id))
     return conversation
 
 @api_router.get("/conversations", response_model=List[Conversation])
-async def get_conversations(current_user: User = Depends(get_current_user)):
+async def get_conversations(response: Response, current_user: User = Depends(get_current_user), if_none_match: Optional[str] = Header(None)):
+    etag = await get_listing_etag(
+        ("conversations", current_user.id),
+        lambda: probe_conversation_list_etag(current_user.id)
+    )
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+    
     conversations = await db.conversations.find({"user_id": current_user.id}).sort("updated_at", -1).to_list(100)
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "private, no-cache"
     return [Conversation(**parse_from_mongo(conv)) for conv in conversations]
 
 @api_router.get("/conversations/{conversation_id}/messages", response_model=List[ChatMessage])
-async def get_messages(conversation_id: str, current_user: User = Depends(get_current_user)):
+async def get_messages(conversation_id: str, response: Response, current_user: User = Depends(get_current_user), if_none_match: Optional[str] = Header(None)):
     # Verify conversation belongs to user
     conversation = await db.conversations.find_one({"id": conversation_id, "user_id": current_user.id})
     if not conversation:
         raise HTTPException(status_code=404, detail="Conversation not found")
     
+    await rehydrate_conversation(conversation)
+    await touch_conversation(conversation)
+    etag = await get_listing_etag(
+        ("messages", conversation_id),
+        lambda: probe_message_list_etag(conversation_id)
+    )
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+    
     messages = await db.messages.find({"conversation_id": conversation_id}).sort("timestamp", 1).to_list(1000)
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "private, no-cache"
     return [ChatMessage(**parse_from_mongo(msg)) for msg in messages]
 
 @api_router.delete("/conversations/{conversation_id}")
@@ -274,13 +795,22 @@ async def delete_conversation(conversation_id: str, current_user: User = Depends
     if not conversation:
         raise HTTPException(status_code=404, detail="Conversation not found")
     
+    # Stop open WebSocket sessions from writing to the conversation
+    for session in list(chat_sessions.get(current_user.id, ())):
+        session.forget_conversation(conversation_id)
+    
     # Delete conversation and all its messages
     await db.conversations.delete_one({"id": conversation_id})
     await db.messages.delete_many({"conversation_id": conversation_id})
+    await db.archived_conversations.delete_one({"conversation_id": conversation_id})
+    await unindex_conversation(current_user.id, conversation_id)
+    invalidate_listing_etag(("conversations", current_user.id))
+    invalidate_listing_etag(("messages", conversation_id))
     return {"message": "Conversation deleted successfully"}
 
-async def get_ai_response(content: str, model: str, task_type: str, conversation_id: str) -> AsyncGenerator[str, None]:
+async def get_ai_response(content: str, model: str, task_type: str, conversation: dict, user_id: str) -> AsyncGenerator[str, None]:
     """Get AI response from the selected model"""
+    conversation_id = conversation["id"]
     try:
         # Prepare system message based on task type
         system_messages = {
@@ -292,10 +822,32 @@ async def get_ai_response(content: str, model: str, task_type: str, conversation
         
         system_message = system_messages.get(task_type, system_messages["general"])
         
+        # Promote the conversation back to hot storage if it was archived
+        await rehydrate_conversation(conversation)
+        
         # Get recent conversation history for context
         recent_messages = await db.messages.find(
             {"conversation_id": conversation_id}
-        ).sort("timestamp", -1).limit(10).to_list(10)
+        ).sort("timestamp", -1).limit(RECENT_HISTORY_LIMIT).to_list(RECENT_HISTORY_LIMIT)
+        
+        # The newest message is the turn being answered; it is sent separately
+        exclude_ids = []
+        if recent_messages and recent_messages[0]["role"] == "user" and recent_messages[0]["content"] == content:
+            exclude_ids.append(recent_messages[0]["id"])
+            recent_messages = recent_messages[1:]
+        
+        # Drop the oldest recent messages that don't fit the budget; they can
+        # still come back through retrieval below
+        recent_messages = trim_recent_history(recent_messages)
+        exclude_ids.extend(msg["id"] for msg in recent_messages)
+        
+        # Pull in relevant messages older than the recent window
+        relevant_messages = await retrieve_relevant_history(user_id, conversation_id, content, exclude_ids)
+        
+        if relevant_messages:
+            system_message += "\n\nRelevant earlier messages from this conversation:\n" + format_history(relevant_messages)
+        if recent_messages:
+            system_message += "\n\nRecent messages from this conversation:\n" + format_history(list(reversed(recent_messages)))
         
         # Initialize chat with appropriate model
         if model.startswith("gpt") or model.startswith("o1") or model.startswith("o3") or model.startswith("o4"):
@@ -327,6 +879,43 @@ async def get_ai_response(content: str, model: str, task_type: str, conversation
         logger.error(f"Error getting AI response: {str(e)}")
         yield f"Error: {str(e)}"
 
+async def save_user_message(chat_request: ChatMessageCreate, user_id: str) -> ChatMessage:
+    user_message = ChatMessage(
+        conversation_id=chat_request.conversation_id,
+        content=chat_request.content,
+        role="user"
+    )
+    
+    prepared_user_msg = prepare_for_mongo(user_message.dict())
+    await db.messages.insert_one(prepared_user_msg)
+    invalidate_listing_etag(("messages", chat_request.conversation_id))
+    await index_message(user_id, user_message)
+    return user_message
+
+async def save_assistant_message(chat_request: ChatMessageCreate, content: str, user_id: str) -> Optional[ChatMessage]:
+    """Save the assistant reply, or return None if the conversation was deleted meanwhile."""
+    # Update conversation timestamp
+    result = await db.conversations.update_one(
+        {"id": chat_request.conversation_id, "user_id": user_id},
+        {"$set": {"updated_at": datetime.now(timezone.utc).isoformat()}}
+    )
+    if result.matched_count == 0:
+        return None
+    
+    assistant_message = ChatMessage(
+        conversation_id=chat_request.conversation_id,
+        content=content,
+        role="assistant",
+        model_used=chat_request.model
+    )
+    
+    prepared_assistant_msg = prepare_for_mongo(assistant_message.dict())
+    await db.messages.insert_one(prepared_assistant_msg)
+    invalidate_listing_etag(("messages", chat_request.conversation_id))
+    invalidate_listing_etag(("conversations", user_id))
+    await index_message(user_id, assistant_message)
+    return assistant_message
+
 @api_router.post("/chat")
 async def chat_with_ai(chat_request: ChatMessageCreate, current_user: User = Depends(get_current_user)):
     try:
@@ -335,15 +924,7 @@ async def chat_with_ai(chat_request: ChatMessageCreate, current_user: User = Dep
         if not conversation:
             raise HTTPException(status_code=404, detail="Conversation not found")
         
-        # Save user message
-        user_message = ChatMessage(
-            conversation_id=chat_request.conversation_id,
-            content=chat_request.content,
-            role="user"
-        )
-        
-        prepared_user_msg = prepare_for_mongo(user_message.dict())
-        await db.messages.insert_one(prepared_user_msg)
+        await save_user_message(chat_request, current_user.id)
         
         # Generate AI response
         async def generate_response():
@@ -352,28 +933,16 @@ async def chat_with_ai(chat_request: ChatMessageCreate, current_user: User = Dep
                 chat_request.content, 
                 chat_request.model, 
                 chat_request.task_type,
-                chat_request.conversation_id
+                conversation,
+                current_user.id
             ):
                 full_response += chunk
                 yield f"data: {json.dumps({'content': chunk, 'done': False})}\n\n"
             
-            # Save assistant message
-            assistant_message = ChatMessage(
-                conversation_id=chat_request.conversation_id,
-                content=full_response,
-                role="assistant",
-                model_used=chat_request.model
-            )
-            
-            prepared_assistant_msg = prepare_for_mongo(assistant_message.dict())
-            await db.messages.insert_one(prepared_assistant_msg)
-            
-            # Update conversation timestamp
-            await db.conversations.update_one(
-                {"id": chat_request.conversation_id},
-                {"$set": {"updated_at": datetime.now(timezone.utc).isoformat()}}
-            )
-            
+            assistant_message = await save_assistant_message(chat_request, full_response, current_user.id)
+            if assistant_message is None:
+                yield f"data: {json.dumps({'content': '', 'done': True, 'error': 'Conversation not found'})}\n\n"
+                return
             yield f"data: {json.dumps({'content': '', 'done': True, 'message_id': assistant_message.id})}\n\n"
         
         return StreamingResponse(
@@ -389,9 +958,272 @@ async def chat_with_ai(chat_request: ChatMessageCreate, current_user: User = Dep
         logger.error(f"Error in chat endpoint: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# WebSocket chat transport
+# Open sessions per user id, so conversation deletes can reach their caches
+chat_sessions = {}
+
+class ChatSocketSession:
+    """One authenticated WebSocket carrying concurrent generations.
+
+    Frames from all generations go through a bounded queue drained by a
+    single writer, so a slow client blocks the generators instead of
+    buffering without limit. Conversation ownership is verified once per
+    conversation, and the conversation (with its archived state) is cached
+    for the lifetime of the socket.
+    """
+
+    def __init__(self, websocket: WebSocket, user: User, expires_at: Optional[float]):
+        self.websocket = websocket
+        self.user = user
+        self.expires_at = expires_at
+        self.close_code = 1000
+        self.conversations = {}
+        self.generations = {}
+        self.outgoing = asyncio.Queue(maxsize=WS_SEND_QUEUE_SIZE)
+        self.last_seen = time.monotonic()
+
+    async def send(self, frame: dict):
+        await self.outgoing.put(frame)
+
+    async def send_error(self, conversation_id: Optional[str], detail: str):
+        await self.send({"type": "error", "conversation_id": conversation_id, "detail": detail})
+
+    def forget_conversation(self, conversation_id: str):
+        self.conversations.pop(conversation_id, None)
+        task = self.generations.get(conversation_id)
+        if task is not None:
+            task.cancel()
+
+    async def run(self):
+        chat_sessions.setdefault(self.user.id, set()).add(self)
+        await self.send({"type": "ready", "user_id": self.user.id})
+        tasks = [
+            asyncio.create_task(self.read_loop()),
+            asyncio.create_task(self.write_loop()),
+            asyncio.create_task(self.heartbeat_loop()),
+        ]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                error = task.exception()
+                if error is not None and not isinstance(error, WebSocketDisconnect):
+                    logger.error(f"Error in chat websocket: {str(error)}")
+        finally:
+            sessions = chat_sessions.get(self.user.id)
+            if sessions is not None:
+                sessions.discard(self)
+                if not sessions:
+                    del chat_sessions[self.user.id]
+            for task in tasks + list(self.generations.values()):
+                task.cancel()
+            if self.websocket.client_state == WebSocketState.CONNECTED:
+                await self.websocket.close(code=self.close_code)
+
+    async def read_loop(self):
+        while True:
+            try:
+                message = await self.websocket.receive_json()
+            except KeyError:
+                # receive_json() looks up the "text" key, so binary frames raise KeyError
+                await self.send_error(None, "Expected a text frame")
+                continue
+            except ValueError:
+                await self.send_error(None, "Invalid JSON")
+                continue
+            self.last_seen = time.monotonic()
+            if not isinstance(message, dict):
+                await self.send_error(None, "Expected a JSON object")
+                continue
+
+            message_type = message.get("type")
+            if message_type == "pong":
+                continue
+            elif message_type == "ping":
+                await self.send({"type": "pong"})
+            elif message_type == "chat":
+                await self.start_generation(message)
+            elif message_type == "auth":
+                await self.reauthenticate(message)
+            elif message_type == "cancel":
+                task = self.generations.get(message.get("conversation_id"))
+                if task is not None:
+                    task.cancel()
+            else:
+                await self.send_error(None, f"Unknown message type: {message_type}")
+
+    async def write_loop(self):
+        while True:
+            frame = await self.outgoing.get()
+            await self.websocket.send_json(frame)
+
+    async def reauthenticate(self, message: dict):
+        # A fresh token for the same user extends the session past the old expiry
+        try:
+            payload = decode_access_token(str(message.get("token", "")))
+            if payload["user_id"] != self.user.id:
+                raise HTTPException(status_code=401, detail="Token belongs to a different user")
+            await get_user_from_payload(payload)
+        except HTTPException as e:
+            await self.send_error(None, e.detail)
+            return
+        self.expires_at = payload.get("exp")
+        await self.send({"type": "authenticated", "expires_at": self.expires_at})
+
+    async def heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(WS_HEARTBEAT_SECONDS)
+            if self.expires_at is not None and time.time() >= self.expires_at:
+                self.close_code = 4401
+                return
+            if time.monotonic() - self.last_seen > 2 * WS_HEARTBEAT_SECONDS:
+                self.close_code = 1001
+                return
+            await self.send({"type": "ping"})
+
+    async def start_generation(self, message: dict):
+        try:
+            chat_request = ChatMessageCreate(**message)
+        except ValidationError:
+            await self.send_error(message.get("conversation_id"), "Invalid chat message")
+            return
+
+        conversation_id = chat_request.conversation_id
+        if conversation_id in self.generations:
+            await self.send_error(conversation_id, "A response is already being generated for this conversation")
+            return
+        if len(self.generations) >= WS_MAX_GENERATIONS:
+            await self.send_error(conversation_id, "Too many concurrent generations")
+            return
+
+        task = asyncio.create_task(self.generate(chat_request))
+        self.generations[conversation_id] = task
+        task.add_done_callback(lambda _: self.generations.pop(conversation_id, None))
+
+    async def generate(self, chat_request: ChatMessageCreate):
+        conversation_id = chat_request.conversation_id
+        try:
+            conversation = self.conversations.get(conversation_id)
+            if conversation is None:
+                conversation = await db.conversations.find_one(
+                    {"id": conversation_id, "user_id": self.user.id}, {"_id": 0, "id": 1, "archived": 1}
+                )
+                if not conversation:
+                    await self.send_error(conversation_id, "Conversation not found")
+                    return
+                self.conversations[conversation_id] = conversation
+            elif not await db.conversations.count_documents({"id": conversation_id, "user_id": self.user.id}, limit=1):
+                # Deleted by a request another worker served since it was cached
+                self.conversations.pop(conversation_id, None)
+                await self.send_error(conversation_id, "Conversation not found")
+                return
+
+            await save_user_message(chat_request, self.user.id)
+
+            full_response = ""
+            async for chunk in get_ai_response(
+                chat_request.content,
+                chat_request.model,
+                chat_request.task_type,
+                conversation,
+                self.user.id
+            ):
+                full_response += chunk
+                await self.send({"type": "chunk", "conversation_id": conversation_id, "content": chunk, "done": False})
+
+            assistant_message = await save_assistant_message(chat_request, full_response, self.user.id)
+            if assistant_message is None:
+                await self.send_error(conversation_id, "Conversation not found")
+                return
+            await self.send({
+                "type": "chunk",
+                "conversation_id": conversation_id,
+                "content": "",
+                "done": True,
+                "message_id": assistant_message.id,
+            })
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error in chat websocket generation: {str(e)}")
+            await self.send_error(conversation_id, str(e))
+
+@api_router.websocket("/ws/chat")
+async def chat_websocket(websocket: WebSocket):
+    await websocket.accept()
+    
+    # Authenticate with the first frame: {"type": "auth", "token": "..."}. The
+    # socket is closed with 4401 once the token expires unless the client
+    # sends another auth frame with a fresh token.
+    try:
+        auth = await asyncio.wait_for(websocket.receive_json(), timeout=WS_HEARTBEAT_SECONDS)
+        if not isinstance(auth, dict) or auth.get("type") != "auth":
+            raise HTTPException(status_code=401, detail="Authentication required")
+        payload = decode_access_token(str(auth.get("token", "")))
+        current_user = await get_user_from_payload(payload)
+    except WebSocketDisconnect:
+        return
+    except (asyncio.TimeoutError, KeyError, ValueError, HTTPException):
+        # KeyError: a binary frame, which receive_json() can't read
+        await websocket.close(code=4401)
+        return
+    
+    await ChatSocketSession(websocket, current_user, payload.get("exp")).run()
+
+# Request profile endpoints (admin only)
+@api_router.get("/admin/profiles")
+async def list_request_profiles(_: None = Depends(require_profile_admin)):
+    return await db.request_profiles.find(
+        {}, {"_id": 0, "collapsed": 0, "timeline": 0}
+    ).sort("started_at", -1).to_list(PROFILE_MAX_STORED)
+
+@api_router.get("/admin/profiles/{profile_id}")
+async def get_request_profile(profile_id: str, _: None = Depends(require_profile_admin)):
+    profile = await db.request_profiles.find_one({"id": profile_id}, {"_id": 0})
+    if not profile:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return profile
+
+@api_router.get("/admin/profiles/{profile_id}/flamegraph")
+async def download_request_flamegraph(profile_id: str, _: None = Depends(require_profile_admin)):
+    profile = await db.request_profiles.find_one({"id": profile_id}, {"_id": 0, "collapsed": 1})
+    if not profile:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return PlainTextResponse(
+        profile["collapsed"],
+        headers={"Content-Disposition": f'attachment; filename="profile-{profile_id}.folded"'}
+    )
+
+# Tiering metrics endpoint (admin only)
+@api_router.get("/admin/tiering/metrics")
+async def get_tiering_metrics(_: None = Depends(require_admin)):
+    latencies = sorted(tiering_metrics["rehydration_ms"])
+
+    def percentile(p: float) -> Optional[float]:
+        if not latencies:
+            return None
+        return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))], 2)
+
+    return {
+        "hot_conversations": await db.conversations.count_documents({"archived": {"$ne": True}}),
+        "archived_conversations": await db.archived_conversations.estimated_document_count(),
+        "hot_messages": await db.messages.estimated_document_count(),
+        "archived_total": tiering_metrics["archived_total"],
+        "rehydrated_total": tiering_metrics["rehydrated_total"],
+        "rehydration_ms": {
+            "p50": percentile(0.5),
+            "p95": percentile(0.95),
+            "max": round(latencies[-1], 2) if latencies else None,
+        },
+        "last_run_at": tiering_metrics["last_run_at"],
+        "last_run_archived": tiering_metrics["last_run_archived"],
+    }
+
 # Include the router in the main app
 app.include_router(api_router)
 
+if PROFILING_ENABLED:
+    app.add_middleware(RequestProfilerMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -407,6 +1239,27 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+tiering_task: Optional[asyncio.Task] = None
+
+@app.on_event("startup")
+async def create_listing_indexes():
+    # Back the listing queries and their ETag probes
+    await db.conversations.create_index([("user_id", 1), ("updated_at", -1)])
+    await db.messages.create_index([("conversation_id", 1), ("timestamp", 1)])
+    # Conversation lookups by id, such as the WebSocket ownership probe
+    await db.conversations.create_index("id", unique=True)
+
+@app.on_event("startup")
+async def start_tiering_job():
+    global tiering_task
+    await db.archived_conversations.create_index("conversation_id", unique=True)
+    # Lets rehydration skip messages that are already hot without a scan
+    await db.messages.create_index("id", unique=True)
+    if ARCHIVE_ENABLED:
+        tiering_task = asyncio.create_task(run_tiering_job())
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    if tiering_task is not None:
+        tiering_task.cancel()
     client.close()
\ No newline at end of file
@@ -0,0 +1,325 @@
+"""Per-user vector index over chat messages.
+
+Each user's index is two append-only files: ``<user_id>.vec`` holds one
+int8-quantised vector plus its float32 scale per message and is
+memory-mapped for search, while ``<user_id>.meta.jsonl`` holds the matching
+message and conversation ids. Message content stays in MongoDB; the index
+only maps text to message ids. Appends take an exclusive lock on
+``<user_id>.lock`` so several worker processes can share one index.
+
+Dropping a conversation rewrites both files without its rows. The new files
+are written next to the old ones and only swapped in once a
+``<user_id>.compact`` marker exists, so a crash mid-swap is rolled forward on
+the next load instead of pairing the new vectors with the old metadata.
+"""
+import importlib
+import json
+import os
+import re
+import threading
+import zlib
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from cachetools import LRUCache
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX platforms
+    fcntl = None
+
+TOKEN_PATTERN = re.compile(r"\w+")
+USER_ID_PATTERN = re.compile(r"[\w-]+")
+
+class HashingEmbedder:
+    """Dependency-free embedder that hashes words into a fixed number of
+    signed buckets. crc32 is used instead of hash() so that vectors stay
+    stable across process restarts."""
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for token in TOKEN_PATTERN.findall(text.lower()):
+                h = zlib.crc32(token.encode('utf-8'))
+                vectors[row, h % self.dim] += 1.0 if h >> 31 else -1.0
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+def load_embedder(spec: Optional[str] = None):
+    """Build an embedder from a ``module:factory`` spec.
+
+    The factory is called without arguments and must return an object with
+    a ``dim`` attribute and an ``embed(texts)`` method returning an
+    ``(len(texts), dim)`` array of L2-normalised vectors.
+    """
+    if not spec:
+        return HashingEmbedder()
+    module_name, _, attr = spec.partition(":")
+    if not module_name or not attr:
+        raise ValueError(f"Invalid embedder spec {spec!r}, expected 'module:factory'")
+    return getattr(importlib.import_module(module_name), attr)()
+
+class UserVectorIndex:
+    def __init__(self, directory: Path, user_id: str, dim: int):
+        if not USER_ID_PATTERN.fullmatch(user_id):
+            raise ValueError(f"Invalid user id for vector index: {user_id!r}")
+        self.vector_path = directory / f"{user_id}.vec"
+        self.meta_path = directory / f"{user_id}.meta.jsonl"
+        self.lock_path = directory / f"{user_id}.lock"
+        self.compact_path = directory / f"{user_id}.compact"
+        self.dim = dim
+        self.row_dtype = np.dtype([("scale", "<f4"), ("vector", "i1", (dim,))])
+        self.lock = threading.Lock()
+        self.message_ids: List[str] = []
+        self.conversation_rows: Dict[str, List[int]] = {}
+        self.vectors: Optional[np.memmap] = None
+        self.meta_size = 0
+        self.meta_inode = None
+        with self.lock, self._file_lock():
+            self._load()
+
+    def __len__(self) -> int:
+        return len(self.message_ids)
+
+    @contextmanager
+    def _file_lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _staged(path: Path) -> Path:
+        return path.with_name(path.name + ".tmp")
+
+    def _finish_compaction(self):
+        for path in (self.vector_path, self.meta_path):
+            staged = self._staged(path)
+            if staged.exists():
+                os.replace(staged, path)
+        self.compact_path.unlink()
+
+    def _meta_inode(self) -> Optional[int]:
+        return self.meta_path.stat().st_ino if self.meta_path.exists() else None
+
+    def _disk_rows(self) -> int:
+        if not self.vector_path.exists():
+            return 0
+        return self.vector_path.stat().st_size // self.row_dtype.itemsize
+
+    def _load(self):
+        """(Re)read the index from disk, cutting off any torn append.
+
+        Must be called with the file lock held.
+        """
+        self.message_ids = []
+        self.conversation_rows = {}
+        self.vectors = None
+
+        if self.compact_path.exists():
+            self._finish_compaction()
+        else:
+            # Left behind by a compaction that crashed before committing
+            for path in (self.vector_path, self.meta_path):
+                self._staged(path).unlink(missing_ok=True)
+
+        entries = []
+        offsets = [0]
+        if self.meta_path.exists():
+            with open(self.meta_path, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        break
+                    offsets.append(offsets[-1] + len(line))
+
+        # Vectors are written before metadata, so a crash mid-append leaves
+        # vector bytes (or a partial meta line) without a matching half.
+        # Truncate both files to the rows that are complete in each so the
+        # next append lands at the right row.
+        rows = min(len(entries), self._disk_rows())
+        if self.vector_path.exists() and self.vector_path.stat().st_size != rows * self.row_dtype.itemsize:
+            os.truncate(self.vector_path, rows * self.row_dtype.itemsize)
+        if self.meta_path.exists() and self.meta_path.stat().st_size != offsets[rows]:
+            os.truncate(self.meta_path, offsets[rows])
+
+        self.meta_size = offsets[rows]
+        self.meta_inode = self._meta_inode()
+        for row, entry in enumerate(entries[:rows]):
+            self.message_ids.append(entry["id"])
+            self.conversation_rows.setdefault(entry["conversation_id"], []).append(row)
+
+    def _stale(self) -> bool:
+        vector_size = self.vector_path.stat().st_size if self.vector_path.exists() else 0
+        meta_size = self.meta_path.stat().st_size if self.meta_path.exists() else 0
+        return (vector_size != len(self.message_ids) * self.row_dtype.itemsize or meta_size != self.meta_size
+                or self._meta_inode() != self.meta_inode or self.compact_path.exists())
+
+    def _refresh(self):
+        """Pick up rows appended by other processes since the last read.
+
+        Only the new metadata lines are parsed; a rewritten index or a torn
+        append falls back to a full ``_load``. Must be called with the file
+        lock held.
+        """
+        if not self._stale():
+            return
+        meta_size = self.meta_path.stat().st_size if self.meta_path.exists() else 0
+        if self.compact_path.exists() or self._meta_inode() != self.meta_inode or meta_size < self.meta_size:
+            self._load()
+            return
+
+        entries = []
+        if self.meta_path.exists():
+            with open(self.meta_path, 'rb') as f:
+                f.seek(self.meta_size)
+                for line in f:
+                    try:
+                        entries.append(json.loads(line) if line.endswith(b"\n") else None)
+                    except ValueError:
+                        entries.append(None)
+        vector_size = self.vector_path.stat().st_size if self.vector_path.exists() else 0
+        if None in entries or vector_size != (len(self.message_ids) + len(entries)) * self.row_dtype.itemsize:
+            self._load()
+            return
+
+        for entry in entries:
+            self.conversation_rows.setdefault(entry["conversation_id"], []).append(len(self.message_ids))
+            self.message_ids.append(entry["id"])
+        self.meta_size = meta_size
+
+    def _mapped(self) -> Optional[np.memmap]:
+        rows = len(self.message_ids)
+        if rows == 0:
+            return None
+        if self.vectors is None or self.vectors.shape[0] != rows:
+            self.vectors = np.memmap(self.vector_path, dtype=self.row_dtype, mode='r', shape=(rows,))
+        return self.vectors
+
+    def add(self, message_id: str, conversation_id: str, vector: np.ndarray):
+        vector = np.asarray(vector, dtype=np.float32)
+        peak = float(np.abs(vector).max()) if vector.size else 0.0
+        row = np.zeros(1, dtype=self.row_dtype)
+        if peak > 0:
+            row["scale"] = peak / 127
+            row["vector"] = np.round(vector / row["scale"][0]).astype(np.int8)
+
+        with self.lock, self._file_lock():
+            # Pick up rows appended (or dropped) by another process, or cut
+            # off a torn append, so the new row number matches its position
+            # on disk.
+            self._refresh()
+            row_number = len(self.message_ids)
+            meta_line = self._encode_meta(message_id, conversation_id)
+
+            with open(self.vector_path, 'ab') as f:
+                f.write(row.tobytes())
+            try:
+                with open(self.meta_path, 'ab') as f:
+                    f.write(meta_line)
+            except Exception:
+                os.truncate(self.vector_path, row_number * self.row_dtype.itemsize)
+                if self.meta_path.exists():
+                    os.truncate(self.meta_path, self.meta_size)
+                raise
+            self.meta_size += len(meta_line)
+            if self.meta_inode is None:
+                self.meta_inode = self._meta_inode()
+            self.conversation_rows.setdefault(conversation_id, []).append(row_number)
+            self.message_ids.append(message_id)
+
+    def drop_conversation(self, conversation_id: str):
+        """Remove every row belonging to a conversation from disk."""
+        with self.lock, self._file_lock():
+            self._refresh()
+            dropped = self.conversation_rows.get(conversation_id)
+            if not dropped:
+                return
+            keep = np.ones(len(self.message_ids), dtype=bool)
+            keep[dropped] = False
+
+            with open(self.meta_path, 'rb') as f:
+                meta_lines = f.read(self.meta_size).splitlines(keepends=True)
+            staged_vectors = self._staged(self.vector_path)
+            staged_meta = self._staged(self.meta_path)
+            with open(staged_vectors, 'wb') as f:
+                f.write(np.asarray(self._mapped()[keep]).tobytes())
+                os.fsync(f.fileno())
+            with open(staged_meta, 'wb') as f:
+                f.writelines(line for line, kept in zip(meta_lines, keep) if kept)
+                os.fsync(f.fileno())
+
+            # Release the old mapping before its file is replaced
+            self.vectors = None
+            with open(self.compact_path, 'w') as f:
+                os.fsync(f.fileno())
+            self._finish_compaction()
+            self._load()
+
+    def _encode_meta(self, message_id: str, conversation_id: str) -> bytes:
+        return (json.dumps({"id": message_id, "conversation_id": conversation_id}) + "\n").encode('utf-8')
+
+    def search(self, query: np.ndarray, conversation_id: str, k: int,
+               exclude_ids: Iterable[str] = ()) -> List[Tuple[str, float]]:
+        with self.lock:
+            if self._stale():
+                with self._file_lock():
+                    self._refresh()
+            vectors = self._mapped()
+            rows = self.conversation_rows.get(conversation_id)
+            if vectors is None or not rows or k <= 0:
+                return []
+            rows = np.asarray(rows, dtype=np.int64)
+            selected = vectors[rows]
+            scores = (selected["vector"].astype(np.float32) @ np.asarray(query, dtype=np.float32)) * selected["scale"]
+
+            # Rank enough candidates to still have k after dropping exclusions
+            excluded = set(exclude_ids)
+            candidates = min(k + len(excluded), rows.size)
+            top = np.argpartition(-scores, candidates - 1)[:candidates]
+            top = top[np.argsort(-scores[top])]
+            results = [(self.message_ids[rows[i]], float(scores[i])) for i in top]
+            return [hit for hit in results if hit[0] not in excluded and hit[1] > 0][:k]
+
+class VectorIndexStore:
+    """Embeds messages and keeps recently used per-user indexes open."""
+
+    def __init__(self, directory: Path, embedder, max_open_indexes: int = 256):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.embedder = embedder
+        self.indexes = LRUCache(maxsize=max_open_indexes)
+        self.lock = threading.Lock()
+
+    def index_for(self, user_id: str) -> UserVectorIndex:
+        with self.lock:
+            index = self.indexes.get(user_id)
+            if index is None:
+                index = UserVectorIndex(self.directory, user_id, self.embedder.dim)
+                self.indexes[user_id] = index
+            return index
+
+    def add_message(self, user_id: str, message_id: str, conversation_id: str, text: str):
+        vector = self.embedder.embed([text])[0]
+        self.index_for(user_id).add(message_id, conversation_id, vector)
+
+    def search(self, user_id: str, conversation_id: str, text: str, k: int,
+               exclude_ids: Iterable[str] = ()) -> List[Tuple[str, float]]:
+        query = self.embedder.embed([text])[0]
+        return self.index_for(user_id).search(query, conversation_id, k, exclude_ids)
+
+    def drop_conversation(self, user_id: str, conversation_id: str):
+        self.index_for(user_id).drop_conversation(conversation_id)
@@ -0,0 +1,178 @@
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+import vector_index  # noqa: E402
+from vector_index import HashingEmbedder, UserVectorIndex, VectorIndexStore, load_embedder  # noqa: E402
+
+USER_ID = "user-1"
+CONVERSATION_ID = "conversation-1"
+MESSAGES = {
+    "m1": "kubernetes helm chart deployment rollout",
+    "m2": "sourdough bread starter hydration",
+    "m3": "python asyncio event loop profiling",
+    "m4": "mountain hiking trail alpine weather",
+}
+
+def make_store(directory: Path) -> VectorIndexStore:
+    return VectorIndexStore(directory, HashingEmbedder())
+
+def add(store: VectorIndexStore, *message_ids: str):
+    for message_id in message_ids:
+        store.add_message(USER_ID, message_id, CONVERSATION_ID, MESSAGES[message_id])
+
+def top_hit(store: VectorIndexStore, message_id: str) -> str:
+    return store.search(USER_ID, CONVERSATION_ID, MESSAGES[message_id], 1)[0][0]
+
+def assert_consistent(directory: Path, store: VectorIndexStore, message_ids):
+    index = store.index_for(USER_ID)
+    assert index.message_ids == list(message_ids)
+    assert (directory / f"{USER_ID}.vec").stat().st_size == len(message_ids) * index.row_dtype.itemsize
+    assert len((directory / f"{USER_ID}.meta.jsonl").read_text().splitlines()) == len(message_ids)
+    for message_id in message_ids:
+        assert top_hit(store, message_id) == message_id
+
+def test_search_returns_relevant_message(tmp_path):
+    store = make_store(tmp_path)
+    add(store, "m1", "m2", "m3")
+    assert top_hit(store, "m2") == "m2"
+    assert [hit for hit, _ in store.search(USER_ID, CONVERSATION_ID, MESSAGES["m2"], 3, ["m2"])] == []
+    assert store.search(USER_ID, "other-conversation", MESSAGES["m2"], 3) == []
+
+def test_orphan_vector_is_truncated_on_load(tmp_path):
+    store = make_store(tmp_path)
+    add(store, "m1", "m2")
+
+    # Crash after the vector write but before the metadata write
+    index = store.index_for(USER_ID)
+    with open(tmp_path / f"{USER_ID}.vec", 'ab') as f:
+        f.write(np.zeros(1, dtype=index.row_dtype).tobytes())
+
+    reopened = make_store(tmp_path)
+    add(reopened, "m3", "m4")
+    assert_consistent(tmp_path, reopened, ["m1", "m2", "m3", "m4"])
+
+def test_orphan_vector_from_another_writer_is_dropped_before_append(tmp_path):
+    store = make_store(tmp_path)
+    add(store, "m1", "m2")
+
+    index = store.index_for(USER_ID)
+    with open(tmp_path / f"{USER_ID}.vec", 'ab') as f:
+        f.write(np.zeros(1, dtype=index.row_dtype).tobytes())
+
+    add(store, "m3")
+    assert_consistent(tmp_path, store, ["m1", "m2", "m3"])
+
+def test_partial_metadata_line_is_truncated_on_load(tmp_path):
+    store = make_store(tmp_path)
+    add(store, "m1", "m2")
+    with open(tmp_path / f"{USER_ID}.meta.jsonl", 'ab') as f:
+        f.write(b'{"id": "m3", "conv')
+
+    reopened = make_store(tmp_path)
+    add(reopened, "m3")
+    assert_consistent(tmp_path, reopened, ["m1", "m2", "m3"])
+
+def test_failed_metadata_write_rolls_back_vector(tmp_path, monkeypatch):
+    store = make_store(tmp_path)
+    add(store, "m1")
+
+    real_open = open
+
+    def failing_open(path, mode='r', *args, **kwargs):
+        if str(path).endswith(".meta.jsonl") and 'a' in mode:
+            raise OSError("disk full")
+        return real_open(path, mode, *args, **kwargs)
+
+    monkeypatch.setattr(vector_index, "open", failing_open, raising=False)
+    with pytest.raises(OSError):
+        add(store, "m2")
+    monkeypatch.undo()
+
+    add(store, "m3")
+    assert_consistent(tmp_path, store, ["m1", "m3"])
+
+def test_interleaved_writers_share_one_index(tmp_path):
+    first = make_store(tmp_path)
+    second = make_store(tmp_path)
+    add(first, "m1")
+    add(second, "m2")
+    add(first, "m3")
+    add(second, "m4")
+
+    assert_consistent(tmp_path, make_store(tmp_path), ["m1", "m2", "m3", "m4"])
+    assert top_hit(first, "m2") == "m2"
+
+def test_rows_from_another_writer_are_read_incrementally(tmp_path, monkeypatch):
+    first = make_store(tmp_path)
+    second = make_store(tmp_path)
+    add(first, "m1")
+    first_index = first.index_for(USER_ID)
+
+    def full_reload():
+        raise AssertionError("unexpected full reload")
+
+    monkeypatch.setattr(first_index, "_load", full_reload)
+    add(second, "m2", "m3")
+    assert top_hit(first, "m3") == "m3"
+    add(first, "m4")
+    monkeypatch.undo()
+
+    assert_consistent(tmp_path, make_store(tmp_path), ["m1", "m2", "m3", "m4"])
+
+def test_load_embedder_defaults_to_hashing_embedder():
+    assert isinstance(load_embedder(""), HashingEmbedder)
+
+@pytest.mark.parametrize("spec", ["embedders", "embedders:", ":make_embedder"])
+def test_load_embedder_rejects_malformed_spec(spec):
+    with pytest.raises(ValueError, match="module:factory"):
+        load_embedder(spec)
+
+def test_invalid_user_id_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        UserVectorIndex(tmp_path, "../escape", 8)
+
+def test_drop_conversation_removes_its_rows(tmp_path):
+    store = make_store(tmp_path)
+    add(store, "m1", "m2")
+    store.add_message(USER_ID, "m3", "other-conversation", MESSAGES["m3"])
+    other = make_store(tmp_path)
+    assert top_hit(other, "m1") == "m1"
+
+    store.drop_conversation(USER_ID, CONVERSATION_ID)
+    assert store.search(USER_ID, CONVERSATION_ID, MESSAGES["m1"], 3) == []
+    assert store.search(USER_ID, "other-conversation", MESSAGES["m3"], 1)[0][0] == "m3"
+    assert "m1" not in (tmp_path / f"{USER_ID}.meta.jsonl").read_text()
+
+    # A worker that still had the old files open picks up the rewrite
+    other.add_message(USER_ID, "m4", "other-conversation", MESSAGES["m4"])
+    assert other.index_for(USER_ID).message_ids == ["m3", "m4"]
+    assert store.search(USER_ID, "other-conversation", MESSAGES["m4"], 1)[0][0] == "m4"
+
+def test_interrupted_compaction_is_rolled_forward(tmp_path):
+    store = make_store(tmp_path)
+    add(store, "m1", "m2")
+    store.add_message(USER_ID, "m3", "other-conversation", MESSAGES["m3"])
+
+    # Crash after the vectors were swapped in but before the metadata was
+    index = store.index_for(USER_ID)
+    finish = index._finish_compaction
+
+    def crash():
+        os.replace(index._staged(index.vector_path), index.vector_path)
+        raise OSError("crashed")
+
+    index._finish_compaction = crash
+    with pytest.raises(OSError):
+        store.drop_conversation(USER_ID, CONVERSATION_ID)
+    index._finish_compaction = finish
+
+    reopened = make_store(tmp_path)
+    assert reopened.index_for(USER_ID).message_ids == ["m3"]
+    assert reopened.search(USER_ID, "other-conversation", MESSAGES["m3"], 1)[0][0] == "m3"
+    assert not (tmp_path / f"{USER_ID}.compact").exists()